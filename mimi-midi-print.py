@@ -2,95 +2,322 @@
 import mido
 import time
 import threading
-from collections import deque
+import queue
 import argparse
 import os
+import platform
+import ctypes
+import ctypes.util
+import errno
+import gc
+import heapq
+from array import array
+
+# Linux上用 clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME) 直接睡到绝对时间点，
+# 被信号打断或重新计算相对时间都不会引入误差（仍有约50us的调度延迟，由忙等待补偿）。
+# perf_counter在Linux上就是CLOCK_MONOTONIC，deadline可以直接传进去；其他平台用time.sleep
+CLOCK_MONOTONIC = 1
+TIMER_ABSTIME = 1
+THREAD_PRIORITY_TIME_CRITICAL = 15  # Windows SetThreadPriority
+# 等待超过这个时间（秒）时，前面大段时间用Event等待，stop()可以随时唤醒播放线程
+STOP_WAIT_MARGIN = 0.05
+
+NOTE_ON = 'note_on'
+NOTE_OFF = 'note_off'
+NOTE_TYPES = (NOTE_ON, NOTE_OFF)
+NOTE_MIN = 24   # 能演奏的音符范围
+NOTE_MAX = 108
+# 事件时间对齐到1ms网格，和弦中相差零点几毫秒的音符会落在同一时刻，一起发送
+TIME_GRID = 0.001
+# 流式播放：解析线程每次解析约LOOKAHEAD秒的事件交给播放线程，最多领先LOOKAHEAD_BLOCKS块
+LOOKAHEAD = 0.5
+LOOKAHEAD_BLOCKS = 2
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _load_clock_nanosleep():
+    """取得libc的clock_nanosleep，不可用时返回None"""
+    if platform.system() != "Linux":
+        return None
+    if time.get_clock_info("perf_counter").implementation != "clock_gettime(CLOCK_MONOTONIC)":
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+        func = libc.clock_nanosleep
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(_Timespec), ctypes.POINTER(_Timespec)]
+    func.restype = ctypes.c_int
+    return func
+
+
+_clock_nanosleep = _load_clock_nanosleep()
+
+
+def _iter_track(track):
+    """逐条产生音轨中的 (绝对tick, 消息)"""
+    tick = 0
+    for msg in track:
+        tick += msg.time
+        yield tick, msg
+
 
 class MidiPlayer:
     def __init__(self):
-        self.note_queue = deque()
-        self.playing = False
+        # 按时间排序的音符事件，按列分开存放：时间(秒)、音符、状态(1=ON, 0=OFF)
+        # load_midi之后只读
+        self.times = array('d')
+        self.notes = array('B')
+        self.states = array('B')
         self.thread = None
+        self.printer = None
+        self._output = queue.SimpleQueue()  # 待打印的控制台输出
+        self._timer_period = False  # 是否调用过timeBeginPeriod(1)（仅Windows）
+        self._stop_event = threading.Event()
+        self._done_event = threading.Event()  # 播放线程结束时置位
+        self._timespec = _Timespec()  # clock_nanosleep的参数，重复使用
+        self._source = None  # 流式播放时的MidiFile，由解析线程边解析边播放
+        self._blocks = None  # 解析线程交给播放线程的事件块
+        self.parser = None
+        # sleep精度补偿：Windows/macOS的sleep有约0.5-1ms抖动，最后2ms改为忙等待；
+        # Linux的sleep只有约50us的误差，不需要忙等待
+        self._spin_margin = 0 if platform.system() == "Linux" else 0.002
 
-    def _send_note(self, note, state="ON"):
+    def _send_note(self, note, state=1):
         """模拟发送音符命令（只在命令行打印）"""
-        print(f"{state}{note}")  # 只打印命令，不实际发送
+        # 只打印命令，不实际发送；打印交给输出线程，不阻塞播放线程
+        self._output.put(f"{'ON' if state else 'OFF'}{note}")
 
     def _play_notes(self):
-        """从队列中播放音符的线程函数"""
-        last_time = 0
-        while self.playing or self.note_queue:
-            if self.note_queue:
-                timestamp, note, state = self.note_queue.popleft()
-                
-                # 等待正确的时间
-                delay = timestamp - last_time
-                if delay > 0:
-                    time.sleep(delay)
-                last_time = timestamp
-                
-                self._send_note(note, state)
+        """播放线程入口：提高本线程的调度优先级，播放期间暂停GC，避免中途被抢占或卡顿"""
+        self._raise_priority()
+        gc.disable()
+        try:
+            self._play_loop()
+        finally:
+            gc.collect()
+            gc.enable()
+            self._done_event.set()
+
+    def _raise_priority(self):
+        """把当前线程设为实时/最高优先级，没有权限时保持默认优先级"""
+        system = platform.system()
+        try:
+            if system == "Linux":
+                # pid为0表示当前线程
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(50))
+            elif system == "Windows":
+                kernel32 = ctypes.windll.kernel32
+                kernel32.SetThreadPriority(kernel32.GetCurrentThread(), THREAD_PRIORITY_TIME_CRITICAL)
+        except OSError:
+            pass
+
+    def _play_loop(self):
+        """按时间顺序播放音符事件"""
+        # 以t0为绝对时间基准（拿到第一块事件时确定），每个事件都对齐到
+        # t0 + timestamp，单次sleep的超时不会累积到后面的音符
+        t0 = None
+        for times, notes, states in self._iter_blocks():
+            if t0 is None:
+                t0 = time.perf_counter()
+            if not self._play_block(t0, times, notes, states):
+                break
+
+    def _play_block(self, t0, times, notes, states):
+        """播放一块事件，播放被stop()中止时返回False"""
+        # 循环里用到的属性和方法先取到局部变量，省掉每个事件的属性查找
+        sleep_until = self._sleep_until
+        send_note = self._send_note
+        n = len(times)
+        i = 0
+        while i < n:
+            start = times[i]
+            
+            # 等待正确的时间，stop()会提前唤醒并结束播放
+            if not sleep_until(t0 + start):
+                return False
+            
+            # 同一时刻（已对齐到TIME_GRID）的事件连续发出，只等待一次
+            while i < n and times[i] == start:
+                send_note(notes[i], states[i])
+                i += 1
+        return True
+
+    def _print_output(self):
+        """控制台输出线程：播放线程只把内容放进队列，打印(stdout I/O)在这里完成"""
+        while True:
+            line = self._output.get()
+            if line is None:
+                break
+            print(line)
+
+    def _sleep_until(self, deadline):
+        """精确等待到deadline（perf_counter时间）：先粗略sleep，最后一小段忙等待。
+        播放被stop()中止时提前返回False"""
+        perf_counter = time.perf_counter
+        spin_margin = self._spin_margin
+        remaining = deadline - perf_counter()
+        if remaining > STOP_WAIT_MARGIN:
+            if self._stop_event.wait(remaining - STOP_WAIT_MARGIN):
+                return False
+            remaining = deadline - perf_counter()
+        if remaining > spin_margin:
+            if _clock_nanosleep is not None:
+                target = deadline - spin_margin
+                ts = self._timespec
+                ts.tv_sec = int(target)
+                ts.tv_nsec = int((target % 1) * 1e9)
+                while _clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, ts, None) == errno.EINTR:
+                    pass
             else:
-                time.sleep(0.001)  # 避免忙等待
+                time.sleep(remaining - spin_margin)
+        while perf_counter() < deadline:
+            pass
+        return not self._stop_event.is_set()
+
+    def _iter_events(self, mid, stats, log):
+        """按时间顺序逐个产生音符事件，时间已对齐到TIME_GRID并去掉同一时刻重复的ON音符。
+        各音轨按tick归并后再按tempo换算成秒，不需要先把整首曲子合并成一个列表；
+        计数写入stats，速度变化等信息通过log输出"""
+        tempo = 500000  # 默认tempo (120 BPM)
+        last_tick = 0
+        seconds = 0.0
+        # 当前时刻（对齐后）已经收录的ON音符，用来去掉同一时刻重复的音符
+        group_time = None
+        group_notes = set()
+        tracks = [_iter_track(track) for track in mid.tracks]
+        for j, (tick, msg) in enumerate(heapq.merge(*tracks, key=lambda x: x[0])):
+            # 按当前速度累加真实时间（秒），速度变化只影响之后的消息
+            if tick != last_tick:
+                seconds += mido.tick2second(tick - last_tick, mid.ticks_per_beat, tempo)
+                last_tick = tick
+            mtype = msg.type
+            
+            # 更新速度（如果收到tempo变化事件）
+            if mtype == 'set_tempo':
+                tempo = msg.tempo
+                log(f"消息 {j}: 速度变化 -> {60000000/tempo:.1f} BPM")
+            
+            # 处理音符事件
+            if mtype in NOTE_TYPES:
+                stats['total'] += 1
+                mnote = msg.note
+                
+                # 只处理指定范围内的音符
+                if NOTE_MIN <= mnote <= NOTE_MAX:
+                    # 确定状态（ON=按下，OFF=释放）
+                    state = 1 if mtype == NOTE_ON and msg.velocity > 0 else 0
+                    
+                    t = round(seconds / TIME_GRID) * TIME_GRID
+                    if t != group_time:
+                        group_time = t
+                        group_notes.clear()
+                    if state:
+                        if mnote in group_notes:
+                            stats['duplicate'] += 1
+                            continue
+                        group_notes.add(mnote)
+                    
+                    stats['valid'] += 1
+                    yield t, mnote, state
+
+    def _report(self, stats, log):
+        """输出解析统计"""
+        if stats['duplicate']:
+            log(f"同一时刻重复的音符: {stats['duplicate']} 个 (已合并)")
+        log(f"\n解析完成: 共找到 {stats['total']} 个音符事件")
+        log(f"有效音符: {stats['valid']} 个 (24-108范围内)")
 
-    def load_midi(self, filepath):
-        """加载并解析MIDI文件"""
+    def _parse_ahead(self):
+        """流式播放的解析线程：边解析边把事件按块交给播放线程，内存里只保留几块事件"""
+        stats = {'total': 0, 'valid': 0, 'duplicate': 0}
+        times = array('d')
+        notes = array('B')
+        states = array('B')
+        block_end = LOOKAHEAD
+        try:
+            for t, note, state in self._iter_events(self._source, stats, self._output.put):
+                # 同一时刻的事件总在同一块里
+                if t >= block_end:
+                    if not self._put_block((times, notes, states)):
+                        return
+                    times = array('d')
+                    notes = array('B')
+                    states = array('B')
+                    block_end = t + LOOKAHEAD
+                times.append(t)
+                notes.append(note)
+                states.append(state)
+            if times and not self._put_block((times, notes, states)):
+                return
+            self._report(stats, self._output.put)
+        finally:
+            self._put_block(None)  # 通知播放线程没有更多事件了
+
+    def _put_block(self, block):
+        """把一块事件放进队列，队列满时等待；播放已停止时返回False"""
+        while not self._stop_event.is_set():
+            try:
+                self._blocks.put(block, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _iter_blocks(self):
+        """播放用的事件块：整首预先解析好的事件，或流式播放时解析线程送来的块"""
+        if self._source is None:
+            yield self.times, self.notes, self.states
+            return
+        while True:
+            # 解析线程停止后不会再送结束标记，等待时也要检查是否已经stop()
+            try:
+                block = self._blocks.get(timeout=0.1)
+            except queue.Empty:
+                if self._stop_event.is_set():
+                    return
+                continue
+            if block is None:
+                return
+            yield block
+
+    def load_midi(self, filepath, stream=False):
+        """加载并解析MIDI文件。stream=True时只打开文件，播放时边解析边播放"""
         if not os.path.exists(filepath):
             print(f"错误: 文件 '{filepath}' 不存在")
             return False
         
         try:
-            mid = mido.MidiFile(filepath)
-            current_time = 0
-            tempo = 500000  # 默认tempo (120 BPM)
+            mid = mido.MidiFile(filepath, clip=True)
             
             print(f"加载MIDI文件: {filepath}")
-            print(f"MIDI信息: {len(mid.tracks)} 个音轨, {mid.length:.2f} 秒")
+            if stream:
+                # mid.length会先把所有音轨合并成一份完整拷贝并缓存在mid上，流式播放时不取
+                print(f"MIDI信息: {len(mid.tracks)} 个音轨")
+            else:
+                print(f"MIDI信息: {len(mid.tracks)} 个音轨, {mid.length:.2f} 秒")
             print(f"每拍ticks数: {mid.ticks_per_beat}")
             
-            total_notes = 0
-            valid_notes = 0
+            if stream:
+                self._source = mid
+                print("流式播放: 边解析边播放")
+                return True
             
-            # 处理所有音轨
-            for i, track in enumerate(mid.tracks):
-                print(f"\n===== 处理音轨 {i+1} =====")
-                track_time = 0
-                for j, msg in enumerate(track):
-                    track_time += msg.time
-                    
-                    # 更新速度（如果收到tempo变化事件）
-                    if msg.type == 'set_tempo':
-                        tempo = msg.tempo
-                        print(f"消息 {j}: 速度变化 -> {60000000/tempo:.1f} BPM")
-                    
-                    # 处理音符事件
-                    if msg.type in ['note_on', 'note_off']:
-                        total_notes += 1
-                        note_info = f"消息 {j}: {msg.type} 音符={msg.note}, 力度={msg.velocity}"
-                        
-                        # 只处理指定范围内的音符
-                        if 24 <= msg.note <= 108:
-                            # 计算真实时间（秒）
-                            seconds = mido.tick2second(
-                                track_time, 
-                                mid.ticks_per_beat, 
-                                tempo
-                            )
-                            
-                            # 确定状态（ON=按下，OFF=释放）
-                            state = "ON" if msg.type == 'note_on' and msg.velocity > 0 else "OFF"
-                            
-                            self.note_queue.append((seconds, msg.note, state))
-                            print(f"{note_info} -> 有效 (时间={seconds:.2f}s)")
-                            valid_notes += 1
-                        else:
-                            print(f"{note_info} -> 无效 (超出范围)")
+            self._source = None
+            stats = {'total': 0, 'valid': 0, 'duplicate': 0}
+            times = array('d')
+            notes = array('B')
+            states = array('B')
+            for t, note, state in self._iter_events(mid, stats, print):
+                times.append(t)
+                notes.append(note)
+                states.append(state)
+            self.times, self.notes, self.states = times, notes, states
             
-            # 按时间排序所有音符事件
-            self.note_queue = deque(sorted(self.note_queue, key=lambda x: x[0]))
-            
-            print(f"\n解析完成: 共找到 {total_notes} 个音符事件")
-            print(f"有效音符: {valid_notes} 个 (24-108范围内)")
+            self._report(stats, print)
             return True
             
         except Exception as e:
@@ -101,37 +328,68 @@ class MidiPlayer:
 
     def play(self):
         """开始播放MIDI"""
-        if not self.note_queue:
+        if not self.times and self._source is None:
             print("没有可播放的音符!")
             return
         
-        self.playing = True
+        self._stop_event.clear()
+        self._done_event.clear()
+        # Windows默认的调度时钟是15.6ms，播放期间把系统定时器精度调到1ms
+        if platform.system() == "Windows":
+            ctypes.windll.winmm.timeBeginPeriod(1)
+            self._timer_period = True
+        self.printer = threading.Thread(target=self._print_output)
+        self.printer.daemon = True
+        self.printer.start()
+        if self._source is not None:
+            self._blocks = queue.Queue(maxsize=LOOKAHEAD_BLOCKS)
+            self.parser = threading.Thread(target=self._parse_ahead)
+            self.parser.daemon = True
+            self.parser.start()
         self.thread = threading.Thread(target=self._play_notes)
         self.thread.daemon = True
         self.thread.start()
         print("开始播放... 按Ctrl+C停止")
 
+    def wait(self):
+        """等待播放结束（可按Ctrl+C打断）"""
+        # 主线程阻塞在Event上直到播放结束，不用反复醒来检查播放线程；
+        # Windows上不带超时的wait不响应Ctrl+C，所以分段等待
+        timeout = 0.5 if platform.system() == "Windows" else None
+        while self.thread and not self._done_event.wait(timeout):
+            pass
+
     def stop(self):
         """停止播放"""
-        self.playing = False
+        self._stop_event.set()
         if self.thread and self.thread.is_alive():
             self.thread.join(timeout=1.0)
+        if self.parser and self.parser.is_alive():
+            self.parser.join(timeout=1.0)
+        # 播放线程结束后再把剩余输出打印完
+        if self.printer and self.printer.is_alive():
+            self._output.put(None)
+            self.printer.join(timeout=1.0)
+        if self._timer_period:
+            ctypes.windll.winmm.timeEndPeriod(1)
+            self._timer_period = False
         print("播放停止")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='MIDI命令模拟器')
     parser.add_argument('midi_file', help='MIDI文件路径')
+    parser.add_argument('--stream', action='store_true',
+                        help='边解析边播放，不预先解析整首曲子（适合很大的MIDI文件）')
     args = parser.parse_args()
     
     player = MidiPlayer()
     
     try:
-        if player.load_midi(args.midi_file):
+        if player.load_midi(args.midi_file, stream=args.stream):
             player.play()
             
             # 等待播放完成（可按Ctrl+C停止）
-            while player.thread and player.thread.is_alive():
-                player.thread.join(0.1)
+            player.wait()
                 
     except KeyboardInterrupt:
         print("\n用户请求停止...")